@@ -0,0 +1,617 @@
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+from django.core import mail
+from django.core.signals import setting_changed
+from django.template.loader import render_to_string
+
+logger = logging.getLogger(__name__)
+
+_CONFIG_CACHE = {}
+
+
+def _clear_configuration_cache(**kwargs):
+    _CONFIG_CACHE.clear()
+    for engine in (EmailEngine, *EmailEngine.__subclasses__()):
+        if "FROM_EMAIL" in vars(engine):
+            engine.FROM_EMAIL = getattr(settings, engine.FROM_EMAIL_SETTING, None)
+
+
+setting_changed.connect(_clear_configuration_cache)
+
+
+@lru_cache(maxsize=256)
+def _render_cached(template_path, frozen_parameters):
+    return render_to_string(template_path, dict(frozen_parameters))
+
+
+@lru_cache(maxsize=256)
+def _read_compiled_template(compiled_path):
+    with open(compiled_path) as compiled_file:
+        return compiled_file.read()
+
+
+def _as_tuple(value):
+    if isinstance(value, tuple):
+        return value
+    if isinstance(value, list):
+        return tuple(value)
+    return (value,) if value else ()
+
+
+def _as_list(value):
+    return list(_as_tuple(value))
+
+
+class _MissingEmpty(dict):
+    def __missing__(self, key):
+        return ""
+
+
+class _TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        # Runs a debt allowance so a single acquire may claim more tokens
+        # than the bucket holds (e.g. a 50-destination batch against a
+        # 14/s rate); the caller then sleeps until the debt is repaid.
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self.last_refill
+            self.tokens = min(float(self.rate), self.tokens + elapsed * self.rate)
+            self.last_refill = now
+            self.tokens -= tokens
+            wait_time = max(0.0, -self.tokens / self.rate)
+        if wait_time:
+            time.sleep(wait_time)
+
+
+class _SESRateLimiter(_TokenBucket):
+    REFRESH_INTERVAL = 300
+
+    def __init__(self, aws_client, default_rate=14):
+        super().__init__(default_rate)
+        self._aws_client = aws_client
+        self._last_refresh = 0.0
+
+    def _refresh_rate(self):
+        now = time.monotonic()
+        if now - self._last_refresh < self.REFRESH_INTERVAL:
+            return
+        self._last_refresh = now
+        try:
+            quota = self._aws_client.get_send_quota()
+            self.rate = float(quota.get("MaxSendRate") or self.rate)
+        except Exception:
+            logger.exception("Send quota refresh failed")
+
+    def acquire(self, tokens=1):
+        self._refresh_rate()
+        super().acquire(tokens)
+
+    def throttle(self):
+        self.rate = max(1.0, self.rate / 2)
+        logger.warning("Send rate halved to %.1f/s after throttling", self.rate)
+
+
+class EmailEngine(ABC):
+    FROM_EMAIL_SETTING = "EMAIL_HOST_USER"
+    FROM_EMAIL = getattr(settings, "EMAIL_HOST_USER", None)
+
+    @classmethod
+    @abstractmethod
+    def build_configuration(cls):
+        pass
+
+    @classmethod
+    def get_configuration(cls):
+        if cls not in _CONFIG_CACHE:
+            _CONFIG_CACHE[cls] = cls.build_configuration()
+        return _CONFIG_CACHE[cls]
+
+    @classmethod
+    @abstractmethod
+    def get_email_sending_parameters(cls, to_email, from_email="", **kwargs):
+        pass
+
+    @classmethod
+    def get_html_message(cls, **kwargs):
+        html_message = ""
+        template_path = kwargs.get("template_path", "")
+        template_parameters = kwargs.get("template_parameters") or {}
+        if template_path:
+            try:
+                frozen_parameters = tuple(sorted(template_parameters.items()))
+                html_message = _render_cached(template_path, frozen_parameters)
+            except TypeError:
+                html_message = render_to_string(template_path, template_parameters)
+        return html_message
+
+    @classmethod
+    def get_html_message_fast(cls, compiled_path, template_parameters):
+        try:
+            template = _read_compiled_template(compiled_path)
+        except OSError:
+            # The fallback assumes compiled_path mirrors a loadable .html
+            # template: either a loader-relative name, or a path under
+            # EMAIL_HOOK_TEMPLATE_DIR with that directory on the template
+            # loader path.
+            template_path = Path(compiled_path).with_suffix(".html")
+            template_dir = getattr(settings, "EMAIL_HOOK_TEMPLATE_DIR", None)
+            if template_dir:
+                try:
+                    template_path = template_path.relative_to(template_dir)
+                except ValueError:
+                    pass
+            return render_to_string(str(template_path), template_parameters)
+        return template.format_map(_MissingEmpty(template_parameters))
+
+    @classmethod
+    def __is_sufficient(cls, data, data_name):
+        errors = []
+        for key, value in data.items():
+            if not value:
+                errors.append(f"{key} in {data_name} is missing")
+        return not errors, errors
+
+    @classmethod
+    def is_configuration_sufficient(cls):
+        configuration = cls.get_configuration()
+        return cls.__is_sufficient(configuration, "configuration")
+
+    @classmethod
+    def is_email_sending_parameters_sufficient(cls, to_email, from_email="", **kwargs):
+        email_parameters = {
+            "to_email": to_email,
+            "from_email": from_email or cls.FROM_EMAIL,
+        }
+        return cls.__is_sufficient(email_parameters, "email sending parameters")
+
+    @classmethod
+    def get_email_status(cls, to_email, from_email="", **kwargs):
+        sufficient, errors = cls.is_configuration_sufficient()
+        if sufficient:
+            sufficient, errors = cls.is_email_sending_parameters_sufficient(
+                to_email, from_email, **kwargs
+            )
+        if errors:
+            logger.error("Cannot send emails: %s", errors)
+        return sufficient
+
+    @classmethod
+    def send_mail_async(cls, to_email, from_email="", **kwargs):
+        sender = threading.Thread(
+            target=cls.send_mail,
+            args=(to_email, from_email),
+            kwargs=kwargs,
+            daemon=True,
+        )
+        sender.start()
+        return sender
+
+    @classmethod
+    def send_mail_bulk(cls, recipients, from_email="", **kwargs):
+        max_workers = getattr(settings, "EMAIL_CONCURRENCY", None) or 14
+        rate_limiter = _TokenBucket(max_workers)
+
+        def send_one(recipient):
+            rate_limiter.acquire()
+            cls.send_mail(recipient, from_email, **kwargs)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(send_one, recipients))
+
+
+class DjangoEmailEngine(EmailEngine):
+    @classmethod
+    def build_configuration(cls):
+        configuration = {
+            "host": getattr(settings, "EMAIL_HOST", None),
+            "port": getattr(settings, "EMAIL_PORT", None),
+            "username": getattr(settings, "EMAIL_HOST_USER", None),
+            "password": getattr(settings, "EMAIL_HOST_PASSWORD", None),
+        }
+        return configuration
+
+    @classmethod
+    def get_email_sending_parameters(cls, to_email, from_email="", **kwargs):
+        from_email = from_email or cls.FROM_EMAIL
+        email_parameters = {
+            "subject": kwargs.get("subject", ""),
+            "message": kwargs.get("message", ""),
+            "from_email": from_email,
+            "recipient_list": _as_list(to_email),
+            "html_message": cls.get_html_message(**kwargs),
+        }
+        return email_parameters
+
+    @classmethod
+    def send_mail(cls, to_email, from_email="", **kwargs):
+        if cls.get_email_status(to_email, from_email, **kwargs):
+            cls.__send_mail(to_email, from_email, **kwargs)
+
+    @classmethod
+    def __send_mail(cls, to_email, from_email="", **kwargs):
+        try:
+            email_parameters = cls.get_email_sending_parameters(
+                to_email, from_email, **kwargs
+            )
+            mail.send_mail(**email_parameters)
+            logger.debug("Email sent to %s", to_email)
+        except Exception:
+            logger.exception("Email sending failed")
+
+
+class PostmarkEmailEngine(EmailEngine):
+    FROM_EMAIL_SETTING = "POSTMARK_SENDER"
+    FROM_EMAIL = getattr(settings, "POSTMARK_SENDER", None)
+    _client = None
+    _client_key = None
+
+    @classmethod
+    def build_configuration(cls):
+        configuration = {
+            "server_token": getattr(settings, "POSTMARK_TOKEN", None),
+        }
+        return configuration
+
+    @classmethod
+    def get_postmark_client(cls):
+        from postmarker.core import PostmarkClient
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        configuration = cls.get_configuration()
+        client_key = hash(tuple(sorted(configuration.items())))
+        if cls._client is not None and cls._client_key == client_key:
+            return cls._client
+        try:
+            cls._client = PostmarkClient(**configuration)
+            cls._client.session.mount(
+                "https://",
+                HTTPAdapter(
+                    pool_connections=20,
+                    pool_maxsize=50,
+                    max_retries=Retry(total=3, backoff_factor=0.3),
+                ),
+            )
+            cls._client_key = client_key
+        except Exception:
+            logger.exception("Postmark client creation failed")
+            cls._client = None
+        return cls._client
+
+    @classmethod
+    def get_email_sending_parameters(cls, to_email, from_email="", **kwargs):
+        from_email = from_email or cls.FROM_EMAIL
+        subject = kwargs.get("subject", "")
+        email_parameters = {
+            "From": from_email,
+            "To": _as_list(to_email),
+            "Cc": _as_list(kwargs.get("ccs")),
+            "Bcc": _as_list(kwargs.get("bccs")),
+            "Subject": subject,
+            "HtmlBody": cls.get_html_message(**kwargs),
+        }
+        return email_parameters
+
+    @classmethod
+    def send_mail(cls, to_email, from_email="", **kwargs):
+        if cls.get_email_status(to_email, from_email, **kwargs):
+            cls.__send_mail(to_email, from_email, **kwargs)
+
+    @classmethod
+    def send_mail_bulk(cls, recipients, from_email="", **kwargs):
+        sufficient, errors = cls.is_configuration_sufficient()
+        if not sufficient:
+            logger.error("Cannot send emails: %s", errors)
+            return
+        from requests.exceptions import ConnectionError, Timeout
+
+        postmark_client = cls.get_postmark_client()
+        if postmark_client is None:
+            logger.error("Cannot send emails: no Postmark client available")
+            return
+        max_attempts = 3
+        for start in range(0, len(recipients), 500):
+            batch = [
+                cls.get_email_sending_parameters(recipient, from_email, **kwargs)
+                for recipient in recipients[start : start + 500]
+            ]
+            for attempt in range(max_attempts):
+                try:
+                    postmark_client.emails.send_batch(*batch)
+                    logger.debug("Email batch of %d sent", len(batch))
+                    break
+                except (ConnectionError, Timeout):
+                    if attempt < max_attempts - 1:
+                        backoff = 2**attempt + random.random()
+                        logger.warning(
+                            "Email batch send failed, retrying in %.1fs", backoff
+                        )
+                        time.sleep(backoff)
+                        continue
+                    logger.exception("Email batch sending failed")
+                except Exception:
+                    logger.exception("Email batch sending failed")
+                    break
+
+    @classmethod
+    def __send_mail(cls, to_email, from_email="", **kwargs):
+        try:
+            postmark_client = cls.get_postmark_client()
+            email_parameters = cls.get_email_sending_parameters(
+                to_email, from_email, **kwargs
+            )
+            postmark_client.emails.send(**email_parameters)
+            logger.debug("Email sent to %s", to_email)
+        except Exception:
+            logger.exception("Email sending failed")
+
+
+class AWSSESEmailEngine(EmailEngine):
+    _client = None
+    _client_key = None
+    _rate_limiter = None
+    _templates = {}
+
+    @classmethod
+    def build_configuration(cls):
+        configuration = {
+            "aws_access_key_id": getattr(settings, "AWS_ACCESS_KEY_ID", None),
+            "aws_secret_access_key": getattr(settings, "AWS_SECRET_ACCESS_KEY", None),
+            "region_name": getattr(settings, "AWS_SES_REGION_NAME", None),
+        }
+        return configuration
+
+    @classmethod
+    def get_aws_ses_client(cls):
+        import boto3
+        from botocore.client import Config
+
+        configuration = cls.get_configuration()
+        client_key = hash(tuple(sorted(configuration.items())))
+        if cls._client is not None and cls._client_key == client_key:
+            return cls._client
+        try:
+            client_config = Config(
+                max_pool_connections=getattr(
+                    settings, "AWS_SES_MAX_POOL_CONNECTIONS", 50
+                ),
+                retries={"max_attempts": 3, "mode": "adaptive"},
+                tcp_keepalive=True,
+            )
+            cls._client = boto3.client("ses", config=client_config, **configuration)
+            cls._client_key = client_key
+        except Exception:
+            logger.exception("Aws client creation failed")
+            cls._client = None
+        return cls._client
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _build_destination(to_addresses, cc_addresses, bcc_addresses):
+        destination = {
+            "ToAddresses": list(to_addresses),
+            "CcAddresses": list(cc_addresses),
+            "BccAddresses": list(bcc_addresses),
+        }
+        return destination
+
+    @classmethod
+    def get_destination_parameters(cls, to_email, **kwargs):
+        return cls._build_destination(
+            _as_tuple(to_email),
+            _as_tuple(kwargs.get("ccs")),
+            _as_tuple(kwargs.get("bccs")),
+        )
+
+    @staticmethod
+    @lru_cache(maxsize=128)
+    def get_message_parameters(subject, html_message):
+        message = {
+            "Subject": {
+                "Charset": "UTF-8",
+                "Data": subject,
+            },
+            "Body": {
+                "Html": {
+                    "Charset": "UTF-8",
+                    "Data": html_message,
+                },
+            },
+        }
+        return message
+
+    @classmethod
+    def get_email_sending_parameters(cls, to_email, from_email="", **kwargs):
+        from_email = from_email or cls.FROM_EMAIL
+        subject = kwargs.get("subject", "")
+        email_parameters = {
+            "Source": from_email,
+            "Destination": cls.get_destination_parameters(to_email, **kwargs),
+            "Message": cls.get_message_parameters(
+                subject, cls.get_html_message(**kwargs)
+            ),
+        }
+        return email_parameters
+
+    @classmethod
+    def get_rate_limiter(cls):
+        if cls._rate_limiter is None:
+            cls._rate_limiter = _SESRateLimiter(cls.get_aws_ses_client())
+        return cls._rate_limiter
+
+    @classmethod
+    def get_template_source(cls, template_path):
+        from django.template.loader import get_template
+
+        template = get_template(template_path)
+        return getattr(template, "template", template).source
+
+    @classmethod
+    def get_or_create_template(cls, subject, html_message):
+        content_hash = hashlib.md5(f"{subject}{html_message}".encode()).hexdigest()
+        template_name = f"email_hook_{content_hash}"
+        if template_name in cls._templates:
+            return template_name
+        aws_client = cls.get_aws_ses_client()
+        try:
+            aws_client.create_template(
+                Template={
+                    "TemplateName": template_name,
+                    "SubjectPart": subject,
+                    "HtmlPart": html_message,
+                }
+            )
+        except aws_client.exceptions.AlreadyExistsException:
+            pass
+        cls._templates[template_name] = True
+        return template_name
+
+    @classmethod
+    def send_mail(cls, to_email, from_email="", **kwargs):
+        if cls.get_email_status(to_email, from_email, **kwargs):
+            return cls.__send_mail(to_email, from_email, **kwargs)
+        return None
+
+    @classmethod
+    def send_mail_bulk(cls, recipients, from_email="", **kwargs):
+        if not kwargs.get("template_path"):
+            super().send_mail_bulk(recipients, from_email, **kwargs)
+            return
+        from botocore.exceptions import ClientError
+
+        sufficient, errors = cls.is_configuration_sufficient()
+        if not sufficient:
+            logger.error("Cannot send emails: %s", errors)
+            return
+        aws_client = cls.get_aws_ses_client()
+        if aws_client is None:
+            logger.error("Cannot send emails: no SES client available")
+            return
+        try:
+            template_source = cls.get_template_source(kwargs["template_path"])
+            template_name = cls.get_or_create_template(
+                kwargs.get("subject", ""), template_source
+            )
+        except Exception:
+            logger.exception("Email template registration failed")
+            return
+        default_template_data = json.dumps(kwargs.get("template_parameters", {}))
+        recipient_contexts = kwargs.get("recipient_contexts", {})
+        rate_limiter = cls.get_rate_limiter()
+        max_attempts = 3
+        for start in range(0, len(recipients), 50):
+            destinations = [
+                {
+                    "Destination": cls.get_destination_parameters(recipient, **kwargs),
+                    "ReplacementTemplateData": json.dumps(
+                        recipient_contexts.get(recipient, {})
+                    ),
+                }
+                for recipient in recipients[start : start + 50]
+            ]
+            for attempt in range(max_attempts):
+                try:
+                    rate_limiter.acquire(len(destinations))
+                    aws_client.send_bulk_templated_email(
+                        Source=from_email or cls.FROM_EMAIL,
+                        Template=template_name,
+                        DefaultTemplateData=default_template_data,
+                        Destinations=destinations,
+                    )
+                    logger.debug("Email batch of %d sent", len(destinations))
+                    break
+                except ClientError as err:
+                    error_code = err.response["Error"]["Code"]
+                    throttled = error_code in (
+                        "Throttling",
+                        "TooManyRequestsException",
+                    )
+                    if throttled:
+                        rate_limiter.throttle()
+                    if throttled and attempt < max_attempts - 1:
+                        backoff = 2**attempt + random.random()
+                        logger.warning(
+                            "Email batch throttled, retrying in %.1fs", backoff
+                        )
+                        time.sleep(backoff)
+                        continue
+                    logger.exception("Email batch sending failed")
+                    break
+                except Exception:
+                    logger.exception("Email batch sending failed")
+                    break
+
+    @classmethod
+    def __send_mail(cls, to_email, from_email="", **kwargs):
+        from botocore.exceptions import ClientError
+
+        try:
+            aws_client = cls.get_aws_ses_client()
+            email_parameters = cls.get_email_sending_parameters(
+                to_email, from_email, **kwargs
+            )
+            rate_limiter = cls.get_rate_limiter()
+        except Exception:
+            logger.exception("Email sending failed")
+            return None
+        max_attempts = 3
+        for attempt in range(max_attempts):
+            try:
+                rate_limiter.acquire()
+                response = aws_client.send_email(**email_parameters)
+                logger.debug(
+                    "Email sent to %s (MessageId %s)",
+                    to_email,
+                    response.get("MessageId"),
+                )
+                return response
+            except ClientError as err:
+                error_code = err.response["Error"]["Code"]
+                throttled = error_code in ("Throttling", "TooManyRequestsException")
+                if throttled:
+                    rate_limiter.throttle()
+                if throttled and attempt < max_attempts - 1:
+                    backoff = 2**attempt + random.random()
+                    logger.warning(
+                        "Send to %s throttled, retrying in %.1fs", to_email, backoff
+                    )
+                    time.sleep(backoff)
+                    continue
+                logger.exception("Email sending failed")
+                return None
+            except Exception:
+                logger.exception("Email sending failed")
+                return None
+        return None
+
+
+_ENGINES = {
+    "DJANGO": DjangoEmailEngine,
+    "POSTMARK": PostmarkEmailEngine,
+    "AWSSES": AWSSESEmailEngine,
+}
+
+
+def email_engine_factory(engine_name):
+    try:
+        return _ENGINES[engine_name]
+    except KeyError:
+        raise ValueError(
+            f"Invalid Engine Name {engine_name}, choose from {list(_ENGINES)}"
+        )
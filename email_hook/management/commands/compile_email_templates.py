@@ -0,0 +1,29 @@
+import re
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+_VARIABLE_TAG = re.compile(r"\{\{\{\{\s*(\w+)\s*\}\}\}\}")
+
+
+def _compile_template(source):
+    escaped = source.replace("{", "{{").replace("}", "}}")
+    return _VARIABLE_TAG.sub(r"{\1}", escaped)
+
+
+class Command(BaseCommand):
+    help = (
+        "Precompile the .html templates under EMAIL_HOOK_TEMPLATE_DIR into "
+        ".ctpl files whose placeholders can be filled with str.format_map"
+    )
+
+    def handle(self, *args, **options):
+        template_dir = getattr(settings, "EMAIL_HOOK_TEMPLATE_DIR", None)
+        if not template_dir or not Path(template_dir).is_dir():
+            raise CommandError("EMAIL_HOOK_TEMPLATE_DIR is not set or does not exist")
+        for template_path in Path(template_dir).rglob("*.html"):
+            compiled = _compile_template(template_path.read_text())
+            compiled_path = template_path.with_suffix(".ctpl")
+            compiled_path.write_text(compiled)
+            self.stdout.write(f"Compiled {template_path} -> {compiled_path}")